@@ -23,16 +23,20 @@ with open("requirements-site.txt") as docs_requirements_file:
 with open("requirements-llm.txt") as llm_requirements_file:
     llm_requirements = llm_requirements_file.read().splitlines()[::-1]
 
+with open("requirements-zarr.txt") as zarr_requirements_file:
+    zarr_requirements = zarr_requirements_file.read().splitlines()[::-1]
+
 with open("requirements-dev.txt") as dev_requirements_file:
     dev_requirements = dev_requirements_file.read().splitlines()[::-1]
 
 EXTRA_DEPENDENCIES = {
     "harmony": stretch_requirements + llm_requirements,
-    "dev": dev_requirements + stretch_requirements + llm_requirements + docs_requirements,
+    "dev": dev_requirements + stretch_requirements + llm_requirements + docs_requirements + zarr_requirements,
     "docs": docs_requirements,
     "stretch": stretch_requirements,
     "translation": llm_requirements,    # for backward compatibility and will be deprecated with "llm"
     "llm": llm_requirements,
+    "zarr": zarr_requirements,
 }
 
 setup(name="subaligner",
@@ -2,11 +2,13 @@ import os
 import math
 import importlib
 import psutil
+import numba
 import numpy as np
 import tensorflow as tf
 import tensorflow.keras.optimizers as tf_optimizers
 
-from typing import Tuple, Optional, Any, List, Generator
+from typing import Tuple, Optional, Any, List, Dict, Generator
+from numba import njit, prange
 from tensorflow.keras.layers import (
     Dense,
     Input,
@@ -44,9 +46,12 @@ class Network(object):
     BI_LSTM = "bi_lstm"
     CONV_1D = "conv_1d"
     TYPES = [LSTM, BI_LSTM, CONV_1D]
+    DUMP_LAYOUT_ATTRIBUTE = "layout"
+    INPUT_LAYOUT = "network_input"  # samples stored as (time steps, features)
 
     __secret = object()
     __UNKNOWN = "unknown"
+    __STEPS_PER_EXECUTION = 50
 
     def __init__(
         self,
@@ -148,6 +153,14 @@ class Network(object):
 
         model = load_model(model_filepath)
         model.load_weights(weights_filepath)
+        config = model.get_config()
+        float32_config = cls.__to_float32_config(config)
+        if float32_config != config:
+            # Layers trained in mixed precision would otherwise keep computing in float16 when the combined
+            # model is loaded for prediction, which is much slower on CPUs
+            float32_model = Model.from_config(float32_config)
+            float32_model.set_weights(model.get_weights())
+            model = float32_model
         model.save(combined_filepath)
 
     @staticmethod
@@ -267,13 +280,11 @@ class Network(object):
             csv_logger,
             earlyStopping,
         ]
+        steps_per_epoch = math.ceil(float(len(train_data)) * (1 - self.hyperparameters.validation_split) / self.hyperparameters.batch_size)
         if not resume:
-            Optimizer = getattr(tf_optimizers, self.hyperparameters.optimizer)
-            self.__model.compile(
-                loss=self.hyperparameters.loss,
-                optimizer=Optimizer(learning_rate=self.hyperparameters.learning_rate),
-                metrics=self.hyperparameters.metrics,
-            )
+            Network.__compile(self.__model, self.hyperparameters, steps_per_epoch)
+        elif Network.__is_jit_enabled():
+            Network.__compile(self.__model, self.hyperparameters, steps_per_epoch, keep_optimizer=True)
         initial_epoch = 0
         if resume:
             assert os.path.isfile(training_log), "{} does not exist and is required by training resumption".format(
@@ -358,13 +369,12 @@ class Network(object):
             csv_logger,
             earlyStopping,
         ]
+        steps_per_epoch = math.ceil(float(train_data_raw.shape[0]) * (1 - validation_split) / batch_size)
+        validation_steps = math.ceil(float(train_data_raw.shape[0]) * validation_split / batch_size)
         if not resume:
-            Optimizer = getattr(tf_optimizers, self.hyperparameters.optimizer)
-            self.__model.compile(
-                loss=self.hyperparameters.loss,
-                optimizer=Optimizer(learning_rate=self.hyperparameters.learning_rate),
-                metrics=self.hyperparameters.metrics,
-            )
+            Network.__compile(self.__model, self.hyperparameters, steps_per_epoch)
+        elif Network.__is_jit_enabled():
+            Network.__compile(self.__model, self.hyperparameters, steps_per_epoch, keep_optimizer=True)
         if resume:
             assert os.path.isfile(training_log), "{} does not exist and is required by training resumption".format(
                 training_log)
@@ -376,8 +386,6 @@ class Network(object):
 
         train_generator = self.__generator(train_data_raw, labels_raw, batch_size, validation_split, is_validation=False)
         test_generator = self.__generator(train_data_raw, labels_raw, batch_size, validation_split, is_validation=True)
-        steps_per_epoch = math.ceil(float(train_data_raw.shape[0]) * (1 - validation_split) / batch_size)
-        validation_steps = math.ceil(float(train_data_raw.shape[0]) * validation_split / batch_size)
 
         try:
             hist = self.__model.fit(
@@ -420,12 +428,8 @@ class Network(object):
         """
 
         network = cls(cls.__secret, input_shape, hyperparameters)
-        Optimizer = getattr(tf_optimizers, hyperparameters.optimizer)
-        network.__model.compile(
-            loss=hyperparameters.loss,
-            optimizer=Optimizer(learning_rate=hyperparameters.learning_rate),
-            metrics=hyperparameters.metrics,
-        )
+        steps_per_epoch = math.ceil(float(len(train_data)) * (1 - hyperparameters.validation_split) / hyperparameters.batch_size)
+        cls.__compile(network.__model, hyperparameters, steps_per_epoch)
         initial_epoch = 0
         hist = network.__model.fit(
             train_data,
@@ -463,17 +467,12 @@ class Network(object):
         initial_epoch = 0
         batch_size = hyperparameters.batch_size
         validation_split = hyperparameters.validation_split
-        Optimizer = getattr(tf_optimizers, hyperparameters.optimizer)
-        network.__model.compile(
-            loss=hyperparameters.loss,
-            optimizer=Optimizer(learning_rate=hyperparameters.learning_rate),
-            metrics=hyperparameters.metrics,
-        )
+        steps_per_epoch = math.ceil(float(train_data_raw.shape[0]) * (1 - validation_split) / batch_size)
+        validation_steps = math.ceil(float(train_data_raw.shape[0]) * validation_split / batch_size)
+        cls.__compile(network.__model, hyperparameters, steps_per_epoch)
 
         train_generator = cls.__generator(train_data_raw, labels_raw, batch_size, validation_split, is_validation=False)
         test_generator = cls.__generator(train_data_raw, labels_raw, batch_size, validation_split, is_validation=True)
-        steps_per_epoch = math.ceil(float(train_data_raw.shape[0]) * (1 - validation_split) / batch_size)
-        validation_steps = math.ceil(float(train_data_raw.shape[0]) * validation_split / batch_size)
 
         hist = network.__model.fit(
             train_generator,
@@ -487,6 +486,44 @@ class Network(object):
 
         return hist.history["val_loss"], hist.history["val_acc"] if int(tf.__version__.split(".")[0]) < 2 else hist.history["val_accuracy"]
 
+    @staticmethod
+    def shuffle_and_normalise(train_data: np.ndarray, labels: np.ndarray, rotate: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+        """Shuffle the training samples, rotate each of them by 90 degrees and subtract the mean sample.
+
+        Arguments:
+            train_data {numpy.ndarray} -- The training data in the shape of (samples, features, time steps).
+            labels {numpy.ndarray} -- The training labels.
+
+        Keyword Arguments:
+            rotate {bool} -- False if the training data is already in the shape of (samples, time steps, features) (default: {True}).
+
+        Returns:
+            tuple -- The float32 network input in the shape of (samples, time steps, features) and the shuffled labels.
+        """
+
+        train_data = np.asarray(train_data)
+        if train_data.dtype == np.float16:
+            # The Numba kernel does not take half-precision input
+            train_data = train_data.astype(np.float32)
+        rand = np.random.default_rng().permutation(len(labels))
+        n_blocks = max(1, min(len(labels), numba.get_num_threads()))
+        return Network.__rotate_and_normalise(train_data, rand, n_blocks, rotate), np.asarray(labels)[rand]
+
+    @staticmethod
+    def get_input_shape_from_dump(train_data_raw: Any) -> Tuple:
+        """Get the network input shape of the training data loaded from a dump.
+
+        Arguments:
+            train_data_raw {h5py.Dataset} -- The HDF5 raw training data.
+
+        Returns:
+            tuple -- The shape of (time steps, features).
+        """
+
+        if Network.__is_in_input_layout(train_data_raw):
+            return tuple(train_data_raw.shape[1:])
+        return train_data_raw.shape[2], train_data_raw.shape[1]
+
     @staticmethod
     def reset() -> None:
         K.clear_session()
@@ -509,7 +546,7 @@ class Network(object):
             hidden = Dropout(hyperparameters.dropout)(hidden)
 
         hidden = Dense(1)(hidden)
-        outputs = Activation("sigmoid")(hidden)
+        outputs = Activation("sigmoid", dtype="float32")(hidden)
 
         return Model(inputs, outputs)
 
@@ -531,10 +568,51 @@ class Network(object):
             hidden = Dropout(hyperparameters.dropout)(hidden)
 
         hidden = Dense(1)(hidden)
-        outputs = Activation("sigmoid")(hidden)
+        outputs = Activation("sigmoid", dtype="float32")(hidden)
 
         return Model(inputs, outputs)
 
+    @staticmethod
+    def __compile(model: Model, hyperparameters: Hyperparameters, steps_per_epoch: int, keep_optimizer: bool = False) -> None:
+        # A resumed model is recompiled with its restored optimizer so that the optimizer state carries over
+        if keep_optimizer and getattr(model, "optimizer", None) is not None:
+            optimizer = model.optimizer
+        else:
+            optimizer = getattr(tf_optimizers, hyperparameters.optimizer)(learning_rate=hyperparameters.learning_rate)
+        compile_kwargs: Dict[str, Any] = {}
+        if Network.__is_jit_enabled():
+            # Run several training steps per XLA-compiled call to amortise the per-batch Python dispatch,
+            # unless batch shapes vary enough for recompilation to outweigh the gain
+            compile_kwargs["jit_compile"] = os.getenv("SUBALIGNER_DYNAMIC_SHAPES", "0") != "1"
+            compile_kwargs["steps_per_execution"] = max(1, min(Network.__STEPS_PER_EXECUTION, steps_per_epoch))
+        model.compile(
+            loss=hyperparameters.loss,
+            optimizer=optimizer,
+            metrics=hyperparameters.metrics,
+            **compile_kwargs
+        )
+
+    @staticmethod
+    def __to_float32_config(config: Any) -> Any:
+        if isinstance(config, dict):
+            return {
+                key: "float32" if key == "dtype" and Network.__is_mixed_precision_policy(value) else Network.__to_float32_config(value)
+                for key, value in config.items()
+            }
+        if isinstance(config, list):
+            return [Network.__to_float32_config(value) for value in config]
+        return config
+
+    @staticmethod
+    def __is_mixed_precision_policy(dtype: Any) -> bool:
+        name = dtype.get("config", {}).get("name") if isinstance(dtype, dict) else dtype
+        return isinstance(name, str) and name.startswith("mixed_")
+
+    @staticmethod
+    def __is_jit_enabled() -> bool:
+        tf_version = tuple(int(v) for v in tf.__version__.split(".")[:2])
+        return os.getenv("SUBALIGNER_JIT", "0") == "1" and tf_version >= (2, 8)
+
     @staticmethod
     def __set_keras_backend(backend: str):
         # Changing backend is no longer supported by tf.keras in TF2
@@ -563,31 +641,53 @@ class Network(object):
         else:
             raise ValueError("Unknown backend: {}".format(backend))
 
+    @staticmethod
+    def __is_in_input_layout(train_data_raw: Any) -> bool:
+        return getattr(train_data_raw, "attrs", {}).get(Network.DUMP_LAYOUT_ATTRIBUTE) == Network.INPUT_LAYOUT
+
+    @staticmethod
+    @njit(parallel=True, fastmath=True)
+    def __rotate_and_normalise(train_data: np.ndarray, order: np.ndarray, n_blocks: int, rotate: bool) -> np.ndarray:
+        # Gather, rotate and accumulate the mean in one pass over the data and subtract the mean in a second one
+        n = train_data.shape[0]
+        steps, features = (train_data.shape[2], train_data.shape[1]) if rotate else (train_data.shape[1], train_data.shape[2])
+        block_size = (n + n_blocks - 1) // n_blocks
+        normalised = np.empty((n, steps, features), dtype=np.float32)
+        partial_sums = np.zeros((n_blocks, steps, features), dtype=np.float64)
+        for block in prange(n_blocks):
+            for i in range(block * block_size, min((block + 1) * block_size, n)):
+                sample = train_data[order[i]]
+                for t in range(steps):
+                    for f in range(features):
+                        value = np.float32(sample[f, steps - 1 - t]) if rotate else np.float32(sample[t, f])
+                        normalised[i, t, f] = value
+                        partial_sums[block, t, f] += value
+        mean = (partial_sums.sum(axis=0) / max(n, 1)).astype(np.float32)
+        for i in prange(n):
+            normalised[i] -= mean
+        return normalised
+
     @staticmethod
     def __generator(train_data_raw: np.ndarray, labels_raw: np.ndarray, batch_size: int, validation_split: float, is_validation: bool) -> Generator:
+        # Read whole HDF5 chunks at a time and slice batches in memory so that each disk read
+        # lines up with chunk boundaries and no chunk gets decompressed more than once per epoch
+        chunk_rows = train_data_raw.chunks[0] if getattr(train_data_raw, "chunks", None) else batch_size
+        rotate = not Network.__is_in_input_layout(train_data_raw)
+        block_size = chunk_rows * batch_size // math.gcd(chunk_rows, batch_size)
         while True:
             total_size = train_data_raw.shape[0]
-            for i in range(0, total_size, batch_size):
-                real_batch_size = total_size - i - 1 if total_size - i - 1 < batch_size else batch_size
-                train_range_right = i + int(real_batch_size * (1 - validation_split))
-                if is_validation:
-                    batched_train_data = train_data_raw[train_range_right:i + real_batch_size]
-                    batched_labels = labels_raw[train_range_right:i + real_batch_size]
-                else:
-                    batched_train_data = train_data_raw[i:train_range_right]
-                    batched_labels = labels_raw[i:train_range_right]
-
-                np_batched_train_data = np.array(batched_train_data)
-                np_batched_labels = np.array(batched_labels)
-
-                rand = np.random.permutation(np.arange(len(np_batched_labels)))
-                np_batched_random_train_data = np_batched_train_data[rand]
-                np_batched_random_labels = np_batched_labels[rand]
-
-                np_batched_random_train_data = np.array(
-                    [np.rot90(m=val, k=1, axes=(0, 1)) for val in np_batched_random_train_data]
-                )
-                np_batched_random_train_data = np_batched_random_train_data - np.mean(np_batched_random_train_data,
-                                                                                      axis=0)
-
-                yield np_batched_random_train_data, np_batched_random_labels
+            for block_start in range(0, total_size, block_size):
+                block_train_data = np.array(train_data_raw[block_start:block_start + block_size])
+                block_labels = np.array(labels_raw[block_start:block_start + block_size])
+                for i in range(block_start, min(block_start + block_size, total_size), batch_size):
+                    real_batch_size = total_size - i - 1 if total_size - i - 1 < batch_size else batch_size
+                    batch_left = i - block_start
+                    train_range_right = batch_left + int(real_batch_size * (1 - validation_split))
+                    if is_validation:
+                        np_batched_train_data = block_train_data[train_range_right:batch_left + real_batch_size]
+                        np_batched_labels = block_labels[train_range_right:batch_left + real_batch_size]
+                    else:
+                        np_batched_train_data = block_train_data[batch_left:train_range_right]
+                        np_batched_labels = block_labels[batch_left:train_range_right]
+
+                    yield Network.shuffle_and_normalise(np_batched_train_data, np_batched_labels, rotate)
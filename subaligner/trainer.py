@@ -1,20 +1,27 @@
+import contextlib
 import datetime
+import hashlib
+import logging
 import os
 import h5py
-import threading
+import psutil
+import shutil
 import traceback
 import concurrent.futures
-import math
 import numpy as np
+import tensorflow as tf
 import multiprocessing as mp
 
-from typing import List, Tuple, Optional
+from typing import Any, Callable, ContextManager, Iterator, List, Tuple, Optional, Set
 from .network import Network
 from .media_helper import MediaHelper
 from .hyperparameters import Hyperparameters
 from .embedder import FeatureEmbedder
 from .exception import TerminalException
 from .logger import Logger
+from ._version import __version__
+
+_worker_threads_pinned = False
 
 
 class Trainer(object):
@@ -23,6 +30,14 @@ class Trainer(object):
 
     EMBEDDING_TIMEOUT = 300  # time out for feature embedding of media files
     __MAX_BYTES = 2 ** 31 - 1
+    __DUMP_CHUNK_BYTES = 2 ** 20  # target size of each chunk in the training data dump
+    __DUMP_CHUNK_CACHE_BYTES = 64 * 2 ** 20  # raw chunk cache used when the training data dump does not fit in memory
+    __FEATURE_CACHE_DIR = "feature_cache"  # features extracted from each pair of media and subtitle files
+    __WORKER_THREAD_ENV_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]
+
+    __slots__ = ("_Trainer__feature_embedder", "_Trainer__LOGGER")
+    __feature_embedder: FeatureEmbedder
+    __LOGGER: logging.Logger
 
     def __init__(self, feature_embedder: FeatureEmbedder) -> None:
         """Initialiser for the training process.
@@ -34,10 +49,14 @@ class Trainer(object):
             NotImplementedError -- Thrown when any Trainer attributes are modified.
         """
 
-        self.__feature_embedder = feature_embedder
-        self.__lock = threading.RLock()
-        self.__media_helper = MediaHelper()
-        self.__LOGGER = Logger().get_logger(__name__)
+        object.__setattr__(self, "_Trainer__feature_embedder", feature_embedder)
+        object.__setattr__(self, "_Trainer__LOGGER", Logger().get_logger(__name__))
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise NotImplementedError("Trainer attributes are immutable")
+
+    def __delattr__(self, name: str) -> None:
+        raise NotImplementedError("Trainer attributes are immutable")
 
     def train(
         self,
@@ -71,100 +90,83 @@ class Trainer(object):
             sound_effect_end_marker: {string} -- A string indicating the end of the ignored sound effect (default: {")"}).
         """
 
-        training_start = datetime.datetime.now()
-        model_filepath = os.path.join(os.path.abspath(model_dir), "model.hdf5")
-        weights_filepath = os.path.join(os.path.abspath(weights_dir), "weights.hdf5")
-        hyperparams_filepath = os.path.join(os.path.abspath(config_dir), "hyperparameters.json")
-
-        if av_file_paths is None or subtitle_file_paths is None:
-            # Load the data and labels dump from the disk
-            training_dump = os.path.join(os.path.abspath(training_dump_dir), "training_dump.hdf5")
-            self.__LOGGER.debug(
-                "Resume training on data dump: ".format(
-                    training_dump
+        with Trainer.__training_acceleration():
+            training_start = datetime.datetime.now()
+            model_filepath = os.path.join(os.path.abspath(model_dir), "model.hdf5")
+            weights_filepath = os.path.join(os.path.abspath(weights_dir), "weights.hdf5")
+            hyperparams_filepath = os.path.join(os.path.abspath(config_dir), "hyperparameters.json")
+
+            if av_file_paths is None or subtitle_file_paths is None:
+                # Load the data and labels dump from the disk
+                training_dump = Trainer.__get_training_dump_path(training_dump_dir)
+                self.__LOGGER.debug("Resume training on data dump: %s", training_dump)
+                with Trainer.__open_training_dump(training_dump) as hf:
+                    train_data_raw = hf["train_data"]
+                    labels_raw = hf["labels"]
+
+                    if resume:
+                        # Load hyperparameters from previous training
+                        loaded_hyperparameters = Hyperparameters.from_file(hyperparams_filepath)
+
+                        # Update the total epochs and save hyperparameters
+                        loaded_hyperparameters.epochs = hyperparameters.epochs
+                        loaded_hyperparameters.to_file(hyperparams_filepath)
+
+                        network = Network.load_model_and_weights(model_filepath, weights_filepath, loaded_hyperparameters)
+                    else:
+                        # Save hyperparameters before each new training
+                        hyperparameters.to_file(hyperparams_filepath)
+
+                        input_shape = Network.get_input_shape_from_dump(train_data_raw)
+                        self.__LOGGER.debug("input_shape: %s", input_shape)
+                        network = Network.get_network(input_shape, hyperparameters)
+
+                    val_loss, val_acc = network.fit_with_generator(
+                        train_data_raw,
+                        labels_raw,
+                        model_filepath,
+                        weights_filepath,
+                        logs_dir,
+                        training_log,
+                        resume,
+                    )
+            else:
+                # Dump extracted data and labels to files for re-training
+                training_dump = Trainer.__get_training_dump_path(training_dump_dir)
+                train_data, labels = Trainer.__extract_data_and_label_from_avs(
+                    self, av_file_paths, subtitle_file_paths, training_dump, hyperparameters.batch_size,
+                    sound_effect_start_marker, sound_effect_end_marker
                 )
-            )
-            with h5py.File(training_dump, "r") as hf:
-                train_data_raw = hf["train_data"]
-                labels_raw = hf["labels"]
-
-                if resume:
-                    # Load hyperparameters from previous training
-                    loaded_hyperparameters = Hyperparameters.from_file(hyperparams_filepath)
 
-                    # Update the total epochs and save hyperparameters
-                    loaded_hyperparameters.epochs = hyperparameters.epochs
-                    loaded_hyperparameters.to_file(hyperparams_filepath)
+                train_data, labels = Network.shuffle_and_normalise(train_data, labels, rotate=False)
 
-                    network = Network.load_model_and_weights(model_filepath, weights_filepath, loaded_hyperparameters)
-                else:
-                    # Save hyperparameters before each new training
-                    hyperparameters.to_file(hyperparams_filepath)
+                input_shape = (train_data.shape[1], train_data.shape[2])
+                self.__LOGGER.debug("input_shape: %s", input_shape)
 
-                    input_shape = (train_data_raw.shape[2], train_data_raw.shape[1])
-                    self.__LOGGER.debug("input_shape: {}".format(input_shape))
-                    network = Network.get_network(input_shape, hyperparameters)
+                # Save hyperparameters before each new training
+                hyperparameters.to_file(hyperparams_filepath)
 
-                val_loss, val_acc = network.fit_with_generator(
-                    train_data_raw,
-                    labels_raw,
+                network = Network.get_network(input_shape, hyperparameters)
+                val_loss, val_acc = network.fit_and_get_history(
+                    train_data,
+                    labels,
                     model_filepath,
                     weights_filepath,
                     logs_dir,
                     training_log,
-                    resume,
+                    False,
                 )
-        else:
-            train_data, labels = Trainer.__extract_data_and_label_from_avs(
-                self, av_file_paths, subtitle_file_paths, sound_effect_start_marker, sound_effect_end_marker
-            )
-
-            # Dump extracted data and labels to files for re-training
-            training_dump = os.path.join(os.path.abspath(training_dump_dir), "training_dump.hdf5")
-            with h5py.File(training_dump, "w") as hf:
-                hf.create_dataset("train_data", data=train_data)
-                hf.create_dataset("labels", data=labels)
 
-            rand = np.random.permutation(np.arange(len(labels)))
-            train_data = train_data[rand]
-            labels = labels[rand]
+            self.__LOGGER.debug("val_loss: %s", min(val_loss))
+            self.__LOGGER.debug("val_acc: %s", max(val_acc))
+            self.__LOGGER.info("Total training time: %s", datetime.datetime.now() - training_start)
 
-            train_data = np.array(
-                [np.rot90(m=val, k=1, axes=(0, 1)) for val in train_data]
-            )
-            train_data = train_data - np.mean(train_data, axis=0)
-
-            input_shape = (train_data.shape[1], train_data.shape[2])
-            self.__LOGGER.debug("input_shape: {}".format(input_shape))
-
-            # Save hyperparameters before each new training
-            hyperparameters.to_file(hyperparams_filepath)
-
-            network = Network.get_network(input_shape, hyperparameters)
-            val_loss, val_acc = network.fit_and_get_history(
-                train_data,
-                labels,
-                model_filepath,
-                weights_filepath,
-                logs_dir,
-                training_log,
-                False,
+            # Save the model together with the weights after training
+            combined_filepath = os.path.join(os.path.abspath(model_dir), "combined.hdf5")
+            network.save_model_and_weights(
+                model_filepath, weights_filepath, combined_filepath
             )
 
-        self.__LOGGER.debug("val_loss: {}".format(min(val_loss)))
-        self.__LOGGER.debug("val_acc: {}".format(max(val_acc)))
-        self.__LOGGER.info(
-            "Total training time: {}".format(
-                str(datetime.datetime.now() - training_start)
-            )
-        )
-
-        # Save the model together with the weights after training
-        combined_filepath = os.path.join(os.path.abspath(model_dir), "combined.hdf5")
-        network.save_model_and_weights(
-            model_filepath, weights_filepath, combined_filepath
-        )
-
     def pre_train(
         self,
         av_file_paths: List[str],
@@ -185,48 +187,40 @@ class Trainer(object):
             sound_effect_end_marker: {string} -- A string indicating the end of the ignored sound effect (default: {")"}).
         """
 
-        training_dump = os.path.join(os.path.abspath(training_dump_dir), "training_dump.hdf5")
-        if os.path.exists(training_dump):
-            with h5py.File(training_dump, "r") as hf:
-                train_data_raw = hf["train_data"]
-                labels_raw = hf["labels"]
+        with Trainer.__training_acceleration():
+            training_dump = Trainer.__get_training_dump_path(training_dump_dir)
+            if os.path.exists(training_dump):
+                with Trainer.__open_training_dump(training_dump) as hf:
+                    train_data_raw = hf["train_data"]
+                    labels_raw = hf["labels"]
+
+                    input_shape = Network.get_input_shape_from_dump(train_data_raw)
+                    self.__LOGGER.debug("input_shape: %s", input_shape)
+
+                    val_loss, val_acc = Network.simple_fit_with_generator(
+                        input_shape,
+                        train_data_raw,
+                        labels_raw,
+                        hyperparameters
+                    )
+            else:
+                train_data, labels = Trainer.__extract_data_and_label_from_avs(
+                    self, av_file_paths, subtitle_file_paths, training_dump, hyperparameters.batch_size,
+                    sound_effect_start_marker, sound_effect_end_marker
+                )
+
+                train_data, labels = Network.shuffle_and_normalise(train_data, labels, rotate=False)
 
-                input_shape = (train_data_raw.shape[2], train_data_raw.shape[1])
-                self.__LOGGER.debug("input_shape: {}".format(input_shape))
+                input_shape = (train_data.shape[1], train_data.shape[2])
+                self.__LOGGER.debug("input_shape: %s", input_shape)
 
-                val_loss, val_acc = Network.simple_fit_with_generator(
+                val_loss, val_acc = Network.simple_fit(
                     input_shape,
-                    train_data_raw,
-                    labels_raw,
+                    train_data,
+                    labels,
                     hyperparameters
                 )
-        else:
-            train_data, labels = Trainer.__extract_data_and_label_from_avs(
-                self, av_file_paths, subtitle_file_paths, sound_effect_start_marker, sound_effect_end_marker
-            )
-            with h5py.File(training_dump, "w") as hf:
-                hf.create_dataset("train_data", data=train_data)
-                hf.create_dataset("labels", data=labels)
-
-            rand = np.random.permutation(np.arange(len(labels)))
-            train_data = train_data[rand]
-            labels = labels[rand]
-
-            train_data = np.array(
-                [np.rot90(m=val, k=1, axes=(0, 1)) for val in train_data]
-            )
-            train_data = train_data - np.mean(train_data, axis=0)
-
-            input_shape = (train_data.shape[1], train_data.shape[2])
-            self.__LOGGER.debug("input_shape: {}".format(input_shape))
-
-            val_loss, val_acc = Network.simple_fit(
-                input_shape,
-                train_data,
-                labels,
-                hyperparameters
-            )
-        return val_loss, val_acc
+            return val_loss, val_acc
 
     @staticmethod
     def get_done_epochs(training_log: str) -> int:
@@ -243,18 +237,163 @@ class Trainer(object):
         training_log_file.close()
         return epochs_done if epochs_done >= 0 else 0
 
+    @staticmethod
+    def __get_training_dump_path(training_dump_dir: str) -> str:
+        file_extension = "zarr" if Trainer.__is_zarr_dump() else "hdf5"
+        return os.path.join(os.path.abspath(training_dump_dir), "training_dump.{}".format(file_extension))
+
+    @staticmethod
+    def __is_zarr_dump() -> bool:
+        return os.getenv("SUBALIGNER_DUMP_FORMAT", "hdf5").lower() == "zarr"
+
+    @staticmethod
+    def __import_zarr() -> Any:
+        try:
+            import zarr
+        except ImportError as e:
+            raise TerminalException(
+                "zarr is required by SUBALIGNER_DUMP_FORMAT=zarr and can be installed with \"pip install 'subaligner[zarr]'\""
+            ) from e
+        if int(zarr.__version__.split(".")[0]) >= 3:
+            raise TerminalException(
+                "SUBALIGNER_DUMP_FORMAT=zarr requires zarr<3 but found zarr {}".format(zarr.__version__)
+            )
+        return zarr
+
+    @staticmethod
+    @contextlib.contextmanager
+    def __open_zarr_dump(training_dump: str, mode: str) -> Iterator[Any]:
+        yield Trainer.__import_zarr().open_group(training_dump, mode=mode)
+
+    @staticmethod
+    def __create_training_dump(training_dump: str) -> ContextManager:
+        if Trainer.__is_zarr_dump():
+            return Trainer.__open_zarr_dump(training_dump, "w")
+        return h5py.File(training_dump, "w", libver="latest")
+
+    @staticmethod
+    def __open_training_dump(training_dump: str) -> ContextManager:
+        if Trainer.__is_zarr_dump():
+            return Trainer.__open_zarr_dump(training_dump, "r")
+        # Hold the whole dump in memory if it comfortably fits so that no epoch goes back to the disk,
+        # otherwise enlarge the raw chunk cache so that decompressed chunks get reused across batches
+        if os.path.getsize(training_dump) < psutil.virtual_memory().available * 0.5:
+            return h5py.File(training_dump, "r", driver="core", backing_store=False)
+        return h5py.File(training_dump, "r", rdcc_nbytes=Trainer.__DUMP_CHUNK_CACHE_BYTES)
+
+    @staticmethod
+    def __replace_training_dump(source: str, destination: str) -> None:
+        # A Zarr dump is a directory which os.replace cannot move onto a non-empty one
+        if os.path.isdir(destination):
+            shutil.rmtree(destination)
+        os.replace(source, destination)
+
+    @staticmethod
+    def __remove_training_dump(training_dump: str) -> None:
+        if os.path.isdir(training_dump):
+            shutil.rmtree(training_dump, ignore_errors=True)
+        elif os.path.exists(training_dump):
+            os.remove(training_dump)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def __training_acceleration() -> Iterator[None]:
+        # XLA and FP16 pay off on GPUs with tensor cores but can slow down small models, so both are opt-in.
+        # Both are process-wide settings and get restored afterwards so that models built later are not affected.
+        jit_enabled = os.getenv("SUBALIGNER_JIT", "0") == "1"
+        fp16_enabled = os.getenv("SUBALIGNER_FP16", "0") == "1"
+        original_jit = tf.config.optimizer.get_jit() if jit_enabled else None
+        set_policy: Optional[Callable] = None
+        original_policy = None
+        if fp16_enabled:
+            get_policy, set_policy = Trainer.__get_mixed_precision_policy_api()
+            original_policy = get_policy()
+        try:
+            if jit_enabled:
+                tf.config.optimizer.set_jit(True)
+            if set_policy is not None:
+                set_policy("mixed_float16")
+            yield
+        finally:
+            if jit_enabled:
+                tf.config.optimizer.set_jit(original_jit)
+            if set_policy is not None:
+                set_policy(original_policy)
+
+    @staticmethod
+    def __get_mixed_precision_policy_api() -> Tuple[Callable, Callable]:
+        mixed_precision = getattr(tf.keras, "mixed_precision", None)
+        if hasattr(mixed_precision, "set_global_policy"):
+            return mixed_precision.global_policy, mixed_precision.set_global_policy
+        experimental = getattr(mixed_precision, "experimental", None)
+        if hasattr(experimental, "set_policy"):
+            return experimental.global_policy, experimental.set_policy
+        raise TerminalException(
+            "SUBALIGNER_FP16=1 requires Keras mixed precision which is not supported by TensorFlow {}".format(tf.__version__)
+        )
+
+    @staticmethod
+    def __append_to_training_dump(hf: Any, x: np.ndarray, y: np.ndarray, batch_size: int) -> None:
+        """Append the data and labels extracted from one media file to the chunked and compressed training dump.
+
+        Arguments:
+            hf {h5py.File or zarr.hierarchy.Group} -- The training data dump opened for writing.
+            x {numpy.ndarray} -- The training data extracted from one media file.
+            y {numpy.ndarray} -- The training labels extracted from one media file.
+            batch_size {int} -- The training batch size which each chunk holds a whole multiple of.
+        """
+
+        # Store samples as (time steps, features) so that each batch read is already in the network input layout
+        x = np.ascontiguousarray(np.rot90(x, k=1, axes=(1, 2)))
+        if "train_data" not in hf:
+            chunk_rows = Trainer.__get_chunk_rows(x, batch_size)
+            if isinstance(hf, h5py.File):
+                hf.create_dataset("train_data", shape=(0,) + x.shape[1:], maxshape=(None,) + x.shape[1:], dtype=x.dtype,
+                                  chunks=(chunk_rows,) + x.shape[1:], compression="lzf", shuffle=True)
+                hf.create_dataset("labels", shape=(0,), maxshape=(None,), dtype="i1",
+                                  chunks=(chunk_rows,), compression="lzf", shuffle=True)
+            else:
+                from numcodecs import Blosc
+                compressor = Blosc(cname="lz4", clevel=1, shuffle=Blosc.SHUFFLE)
+                hf.create_dataset("train_data", shape=(0,) + x.shape[1:], dtype=x.dtype,
+                                  chunks=(chunk_rows,) + x.shape[1:], compressor=compressor)
+                hf.create_dataset("labels", shape=(0,), dtype="i1", chunks=(chunk_rows,), compressor=compressor)
+            hf["train_data"].attrs[Network.DUMP_LAYOUT_ATTRIBUTE] = Network.INPUT_LAYOUT
+        if len(x) == 0:
+            return
+        train_ds, labels_ds = hf["train_data"], hf["labels"]
+        if isinstance(hf, h5py.File):
+            train_ds.resize(train_ds.shape[0] + len(x), axis=0)
+            train_ds[-len(x):] = x
+            labels_ds.resize(labels_ds.shape[0] + len(y), axis=0)
+            labels_ds[-len(y):] = y
+        else:
+            train_ds.append(x)
+            labels_ds.append(y)
+
+    @staticmethod
+    def __get_chunk_rows(train_data: np.ndarray, batch_size: int) -> int:
+        # Whole batches per chunk so that sequential batch reads never straddle two chunks
+        row_bytes = max(int(np.prod(train_data.shape[1:])) * train_data.dtype.itemsize, 1)
+        batches_per_chunk = max(Trainer.__DUMP_CHUNK_BYTES // (row_bytes * batch_size), 1)
+        return batches_per_chunk * batch_size
+
     def __extract_data_and_label_from_avs(
         self,
         av_file_paths: List[str],
         subtitle_file_paths: List[str],
+        training_dump: str,
+        batch_size: int,
         sound_effect_start_marker: Optional[str],
         sound_effect_end_marker: Optional[str],
     ) -> Tuple[np.ndarray, np.ndarray]:
-        """Generate a training dataset and labels from audio/video files.
+        """Generate a training dataset and labels from audio/video files and dump them to the disk.
 
         Arguments:
             av_file_paths {list} -- A list of paths to the input audio/video files.
             subtitle_file_paths {list} -- A list of paths to the subtitle files.
+            training_dump {string} -- The path to the training data dump file.
+            batch_size {int} -- The training batch size used for chunking the training data dump.
             sound_effect_start_marker: {string} -- A string indicating the start of the ignored sound effect.
             sound_effect_end_marker: {string} -- A string indicating the end of the ignored sound effect.
 
@@ -262,119 +401,227 @@ class Trainer(object):
             tuple -- The training data and labels.
         """
 
-        train_data, labels = (
-            [None] * len(av_file_paths),
-            [None] * len(subtitle_file_paths),
-        )
-
         extraction_start = datetime.datetime.now()
-        max_workers = math.ceil(float(os.getenv("MAX_WORKERS", mp.cpu_count() / 2)))
-        with concurrent.futures.ThreadPoolExecutor(
-            max_workers=max_workers
-        ) as executor:
-            futures = [
-                executor.submit(
-                    Trainer.__extract_in_multithreads,
-                    self,
-                    index,
-                    av_file_paths[index],
-                    subtitle_file_paths[index],
-                    train_data,
-                    labels,
-                    sound_effect_start_marker,
-                    sound_effect_end_marker
-                )
-                for index in range(len(av_file_paths))
-            ]
-            try:
-                done, not_done = concurrent.futures.wait(futures, timeout=Trainer.EMBEDDING_TIMEOUT)
-            except KeyboardInterrupt:
-                for future in futures:
-                    if not future.cancel():
-                        self.__LOGGER.warning("Data and label extraction job cannot be cancelled")
-                raise TerminalException("Data and label extraction interrupted by the user")
-            for future in not_done:
-                # Log undone audio files and continue
-                try:
-                    audio_file_path, subtitle_file_path = future.result()
-                    self.__LOGGER.warning(
-                        "Data and label extraction failed for: [Audio: {}, Subtitle: {}]".format(
-                            audio_file_path, subtitle_file_path
-                        )
-                    )
-                    if not future.cancel():
-                        self.__LOGGER.warning("Data and label extraction job cannot be cancelled")
-                except Exception as e:
-                    self.__LOGGER.error(
-                        "Unexpected exception during data and label extraction: {} stacktrace: {}".format(
-                            str(e), "".join(traceback.format_stack())
-                        )
+        # Features are cached next to the dump unless SUBALIGNER_FEATURE_CACHE=0, and the cache is never pruned
+        feature_cache_dir: Optional[str] = None
+        if os.getenv("SUBALIGNER_FEATURE_CACHE", "1") != "0":
+            feature_cache_dir = os.path.join(os.path.dirname(training_dump), Trainer.__FEATURE_CACHE_DIR)
+            os.makedirs(feature_cache_dir, exist_ok=True)
+        max_workers = max(1, min(mp.cpu_count(), int(os.getenv("MAX_WORKERS", mp.cpu_count() // 2))))
+        # Build the dump under a temporary name so that an interrupted or failed extraction never
+        # destroys the previous dump or leaves a partial one behind for later training to pick up
+        temp_training_dump = "{}.{}.tmp".format(training_dump, os.getpid())
+        try:
+            with Trainer.__single_threaded_workers(), Trainer.__create_training_dump(temp_training_dump) as hf, \
+                    concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    executor.submit(
+                        Trainer._extract_in_multiprocesses,
+                        self.__feature_embedder,
+                        feature_cache_dir,
+                        index,
+                        av_file_paths[index],
+                        subtitle_file_paths[index],
+                        sound_effect_start_marker,
+                        sound_effect_end_marker
                     )
-                    traceback.print_tb(e.__traceback__)
+                    for index in range(len(av_file_paths))
+                ]
+                # Write each shard as soon as it is extracted so that dumping overlaps with the remaining extraction
+                dumped: Set[concurrent.futures.Future] = set()
+                try:
+                    try:
+                        for future in concurrent.futures.as_completed(futures, timeout=Trainer.EMBEDDING_TIMEOUT):
+                            self.__dump_extraction_result(hf, future, batch_size)
+                            dumped.add(future)
+                    except concurrent.futures.TimeoutError:
+                        not_done = [future for future in futures if future not in dumped]
+                        for future in not_done:
+                            # Log undone audio files and continue
+                            index = futures.index(future)
+                            self.__LOGGER.warning(
+                                "Data and label extraction timed out for: [Audio: %s, Subtitle: %s]",
+                                av_file_paths[index], subtitle_file_paths[index]
+                            )
+                        for future in concurrent.futures.as_completed(not_done):
+                            self.__dump_extraction_result(hf, future, batch_size)
+                except KeyboardInterrupt:
+                    for future in futures:
+                        if not future.cancel():
+                            self.__LOGGER.warning("Data and label extraction job cannot be cancelled")
+                    raise TerminalException("Data and label extraction interrupted by the user")
+
+                if "train_data" not in hf:
+                    raise TerminalException("No data and labels were extracted for training")
+                train_data = Trainer.__read_as_float32(hf["train_data"])
+                labels: np.ndarray = hf["labels"][:]
+            Trainer.__replace_training_dump(temp_training_dump, training_dump)
+        finally:
+            Trainer.__remove_training_dump(temp_training_dump)
+        self.__LOGGER.debug("Data and labels extracted after %s seconds", datetime.datetime.now() - extraction_start)
 
-        train_data = [x for x in train_data if x is not None]
-        labels = [x for x in labels if x is not None]
+        return train_data, labels
 
-        train_data: np.ndarray = np.concatenate(train_data)  # type: ignore
-        labels: np.ndarray = np.concatenate(labels)  # type: ignore
-        self.__LOGGER.debug(
-            "Data and labels extracted after {} seconds".format(
-                str(datetime.datetime.now() - extraction_start)
+    @staticmethod
+    def __read_as_float32(dataset: Any) -> np.ndarray:
+        # Widen half-precision features one chunk at a time so that a whole float16 copy
+        # never has to coexist with the whole float32 array handed over to training
+        train_data = np.empty(dataset.shape, dtype=np.float32)
+        step = dataset.chunks[0] if dataset.chunks else len(train_data)
+        for start in range(0, len(train_data), max(1, step)):
+            train_data[start:start + step] = dataset[start:start + step]
+        return train_data
+
+    def __dump_extraction_result(self, hf: Any, future: concurrent.futures.Future, batch_size: int) -> None:
+        try:
+            _, x, y = future.result()
+        except Exception as e:
+            self.__LOGGER.error(
+                "Unexpected exception during data and label extraction: %s stacktrace: %s", e, traceback.format_exc()
             )
-        )
+        else:
+            if x is not None:
+                Trainer.__append_to_training_dump(hf, x, y, batch_size)
 
-        return train_data, labels
+    @staticmethod
+    @contextlib.contextmanager
+    def __single_threaded_workers() -> Iterator[None]:
+        # Spawned workers import numpy and TensorFlow before running any task, so their thread pools
+        # are sized before the first task runs and can only be capped through the environment inherited from here
+        original_env = {name: os.environ.get(name) for name in Trainer.__WORKER_THREAD_ENV_VARS}
+        os.environ.update({name: "1" for name in Trainer.__WORKER_THREAD_ENV_VARS})
+        try:
+            yield
+        finally:
+            for name, value in original_env.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
 
-    def __extract_in_multithreads(
-        self,
+    @staticmethod
+    def __pin_worker_threads() -> None:
+        # Pin each worker to a single TF thread so that the aggregate parallelism equals the pool size.
+        # This runs on the first task instead of in a pool initializer which is not available on Python 3.6.
+        global _worker_threads_pinned
+        if _worker_threads_pinned or mp.current_process().name == "MainProcess":
+            # Leave the thread pools of any process calling this outside the pool untouched
+            return
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(1)
+            tf.config.threading.set_inter_op_parallelism_threads(1)
+        except RuntimeError:
+            # The TF context already exists, e.g., in a worker forked from an initialised parent
+            pass
+        _worker_threads_pinned = True
+
+    @staticmethod
+    def _extract_in_multiprocesses(
+        feature_embedder: FeatureEmbedder,
+        feature_cache_dir: Optional[str],
         index: int,
         av_file_path: str,
         subtitle_file_path: str,
-        train_data: np.ndarray,
-        labels: np.ndarray,
         sound_effect_start_marker: Optional[str],
         sound_effect_end_marker: Optional[str]
-    ) -> Tuple[str, str]:
+    ) -> Tuple[int, Optional[np.ndarray], Optional[np.ndarray]]:
+        Trainer.__pin_worker_threads()
+        logger = Logger().get_logger(__name__)
+        media_helper = MediaHelper()
         _, file_ext = os.path.splitext(av_file_path)
+        audio_file_path = av_file_path
+        feature_dtype = Trainer.__get_feature_dtype()
 
         try:
-            if file_ext not in self.__media_helper.AUDIO_FILE_EXTENSION:
-                t = datetime.datetime.now()
-                audio_file_path = self.__media_helper.extract_audio(
+            cache_file_path = None if feature_cache_dir is None else Trainer.__get_feature_cache_path(
+                feature_cache_dir, feature_embedder, av_file_path, subtitle_file_path,
+                sound_effect_start_marker, sound_effect_end_marker
+            )
+            if cache_file_path is not None and os.path.isfile(cache_file_path):
+                try:
+                    with h5py.File(cache_file_path, "r") as hf:
+                        if hf["train_data"].dtype != np.float32:
+                            raise ValueError("Unexpected feature dtype {}".format(hf["train_data"].dtype))
+                        return (
+                            index,
+                            hf["train_data"][()].astype(feature_dtype, copy=False),
+                            Trainer.__to_int8_labels(hf["labels"][()])
+                        )
+                except Exception as e:
+                    logger.warning("Ignoring the unreadable feature cache %s: %s", cache_file_path, e)
+
+            if file_ext not in media_helper.AUDIO_FILE_EXTENSION:
+                t = datetime.datetime.now() if logger.isEnabledFor(logging.DEBUG) else None
+                audio_file_path = media_helper.extract_audio(
                     av_file_path, True, 16000
                 )
-                self.__LOGGER.debug(
-                    "- Audio extracted after {}".format(
-                        str(datetime.datetime.now() - t)
-                    )
-                )
-            else:
-                audio_file_path = av_file_path
-            with self.__lock:
-                x, y = self.__feature_embedder.extract_data_and_label_from_audio(
-                    audio_file_path,
-                    subtitle_file_path,
-                    subtitles=None,
-                    sound_effect_start_marker=sound_effect_start_marker,
-                    sound_effect_end_marker=sound_effect_end_marker
-                )
+                if t is not None:
+                    logger.debug("- Audio extracted after %s", datetime.datetime.now() - t)
+            x, y = feature_embedder.extract_data_and_label_from_audio(
+                audio_file_path,
+                subtitle_file_path,
+                subtitles=None,
+                sound_effect_start_marker=sound_effect_start_marker,
+                sound_effect_end_marker=sound_effect_end_marker
+            )
+            y = Trainer.__to_int8_labels(y)
+            # Always cache full-precision features so that entries serve runs with any feature dtype
+            x = x.astype(np.float32, copy=False)
+            if cache_file_path is not None:
+                try:
+                    Trainer.__write_feature_cache(cache_file_path, x, y)
+                except Exception as e:
+                    logger.warning("Cannot write the feature cache %s: %s", cache_file_path, e)
+            # Downcast before the features leave the worker so that every later copy, write and transfer is smaller
+            x = x.astype(feature_dtype, copy=False)
 
         # Some media files are malformed and on occurring they will be logged
         # However, the training shall continue after expensive embedding on healthy media files.
         except Exception as e:
             # Log failed audio and subtitle files and continue
-            self.__LOGGER.warning(
-                "Exception: {}; stacktrace: {}".format(
-                    str(e), "".join(traceback.format_stack())
-                )
-            )
-            self.__LOGGER.warning(
-                "[Audio: {}, Subtitle: {}]".format(
-                    audio_file_path, subtitle_file_path
-                )
-            )
-            traceback.print_tb(e.__traceback__)
-        else:
-            train_data[index] = x
-            labels[index] = y
-        return audio_file_path, subtitle_file_path
+            logger.warning("Exception: %s; stacktrace: %s", e, traceback.format_exc())
+            logger.warning("[Audio: %s, Subtitle: %s]", audio_file_path, subtitle_file_path)
+            return index, None, None
+        return index, x, y
+
+    @staticmethod
+    def __to_int8_labels(labels: np.ndarray) -> np.ndarray:
+        # Labels are binary so int8 keeps them exact at an eighth of the float64 size
+        assert len(labels) == 0 or (labels.min() >= np.iinfo(np.int8).min and labels.max() <= np.iinfo(np.int8).max), \
+            "Labels are out of the int8 range"
+        return labels.astype(np.int8, copy=False)
+
+    @staticmethod
+    def __get_feature_dtype() -> np.dtype:
+        # Half-precision features are only worthwhile when the network is also trained in mixed precision
+        if os.getenv("SUBALIGNER_FP16", "0") == "1" and os.getenv("SUBALIGNER_FEATURE_DTYPE", "float32") == "float16":
+            return np.dtype(np.float16)
+        return np.dtype(np.float32)
+
+    @staticmethod
+    def __get_feature_cache_path(
+        feature_cache_dir: str,
+        feature_embedder: FeatureEmbedder,
+        av_file_path: str,
+        subtitle_file_path: str,
+        sound_effect_start_marker: Optional[str],
+        sound_effect_end_marker: Optional[str]
+    ) -> str:
+        # Any change to either file or to how features are embedded results in a new cache entry
+        key = ":".join(str(part) for part in [
+            os.path.abspath(av_file_path), os.path.getmtime(av_file_path),
+            os.path.abspath(subtitle_file_path), os.path.getmtime(subtitle_file_path),
+            sound_effect_start_marker, sound_effect_end_marker,
+            feature_embedder.n_mfcc, feature_embedder.frequency, feature_embedder.hop_len,
+            feature_embedder.get_len_mfcc(), feature_embedder.get_step_mfcc(), __version__
+        ])
+        return os.path.join(feature_cache_dir, "{}.h5".format(hashlib.blake2b(key.encode("utf-8")).hexdigest()))
+
+    @staticmethod
+    def __write_feature_cache(cache_file_path: str, x: np.ndarray, y: np.ndarray) -> None:
+        # Write to a temporary file first so that an interrupted write never leaves a truncated cache entry behind
+        temp_file_path = "{}.{}.tmp".format(cache_file_path, os.getpid())
+        with h5py.File(temp_file_path, "w") as hf:
+            hf.create_dataset("train_data", data=x, compression="lzf", shuffle=True)
+            hf.create_dataset("labels", data=y, compression="lzf", shuffle=True)
+        os.replace(temp_file_path, cache_file_path)
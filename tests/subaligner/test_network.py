@@ -4,6 +4,7 @@ import pickle
 import shutil
 import h5py
 import numpy as np
+import tensorflow as tf
 
 from mock import patch
 from parameterized import parameterized
@@ -68,6 +69,26 @@ class NetworkTests(unittest.TestCase):
         )
         self.assertEqual((2, 20), Undertest.get_from_model(model_filepath, self.hyperparameters).input_shape)
 
+    def test_save_model_and_weights_in_float32_after_mixed_precision_training(self):
+        model_filepath = "{}/{}".format(self.resource_tmp, "model.hdf5")
+        weights_filepath = "{}/{}".format(self.resource_tmp, "weights.hdf5")
+        combined_filepath = "{}/{}".format(self.resource_tmp, "model_combined.hdf5")
+        tf.keras.mixed_precision.set_global_policy("mixed_float16")
+        try:
+            network = Undertest.get_network((2, 20), self.hyperparameters)
+            model = network._Network__model
+            model.save(model_filepath)
+            model.save_weights(weights_filepath)
+        finally:
+            tf.keras.mixed_precision.set_global_policy("float32")
+
+        Undertest.save_model_and_weights(model_filepath, weights_filepath, combined_filepath)
+
+        combined_model = Undertest.get_from_model(combined_filepath, self.hyperparameters)._Network__model
+        self.assertTrue(all(layer.dtype_policy.name == "float32" for layer in combined_model.layers))
+        for expected, actual in zip(model.get_weights(), combined_model.get_weights()):
+            np.testing.assert_array_equal(expected, actual)
+
     def test_input_shape(self):
         network = Undertest.get_network((2, 20), self.hyperparameters)
         self.assertEqual((2, 20), network.input_shape)
@@ -258,6 +279,65 @@ class NetworkTests(unittest.TestCase):
             self.assertTrue(len(val_loss) == self.hyperparameters.epochs)
             self.assertTrue(len(val_acc) == self.hyperparameters.epochs)
 
+    @patch.dict(os.environ, {"SUBALIGNER_JIT": "1"})
+    def test_fit_and_get_history_with_jit(self):
+        network = Undertest.get_network((2, 20), self.hyperparameters)
+        with open(self.train_data, "rb") as file:
+            train_data = pickle.load(file)
+        with open(self.labels, "rb") as file:
+            labels = pickle.load(file)
+        val_loss, val_acc = network.fit_and_get_history(
+            train_data,
+            labels,
+            "{}/model.hdf5".format(self.resource_tmp),
+            "{}/weights.hdf5".format(self.resource_tmp),
+            self.resource_tmp,
+            "{}/training.log".format(self.resource_tmp),
+            False,
+        )
+        self.assertEqual(self.hyperparameters.epochs, len(val_loss))
+        self.assertEqual(self.hyperparameters.epochs, len(val_acc))
+        self.assertTrue(network._Network__model._jit_compile)
+        self.assertGreater(int(network._Network__model._steps_per_execution.numpy()), 1)
+
+    @patch.dict(os.environ, {"SUBALIGNER_JIT": "1"})
+    def test_resume_with_generator_and_jit(self):
+        self.hyperparameters.epochs = 2
+        model_filepath = "{}/model.hdf5".format(self.resource_tmp)
+        weights_filepath = "{}/weights.hdf5".format(self.resource_tmp)
+        training_log = "{}/training.log".format(self.resource_tmp)
+        with h5py.File(self.training_dump, "r") as hf:
+            Undertest.get_network((2, 20), self.hyperparameters).fit_with_generator(
+                hf["train_data"], hf["labels"], model_filepath, weights_filepath, self.resource_tmp, training_log, False
+            )
+            self.hyperparameters.epochs = 3
+            network = Undertest.load_model_and_weights(model_filepath, weights_filepath, self.hyperparameters)
+            val_loss, val_acc = network.fit_with_generator(
+                hf["train_data"], hf["labels"], model_filepath, weights_filepath, self.resource_tmp, training_log, True
+            )
+        self.assertEqual(1, len(val_loss))
+        self.assertEqual(1, len(val_acc))
+        self.assertTrue(network._Network__model._jit_compile)
+        self.assertGreater(int(network._Network__model._steps_per_execution.numpy()), 1)
+        self.assertGreater(int(network._Network__model.optimizer.iterations.numpy()), 0)
+
+    @patch.dict(os.environ, {"SUBALIGNER_JIT": "1", "SUBALIGNER_DYNAMIC_SHAPES": "1"})
+    def test_fit_with_generator_and_dynamic_shapes(self):
+        network = Undertest.get_network((2, 20), self.hyperparameters)
+        with h5py.File(self.training_dump, "r") as hf:
+            val_loss, _ = network.fit_with_generator(
+                hf["train_data"],
+                hf["labels"],
+                "{}/model.hdf5".format(self.resource_tmp),
+                "{}/weights.hdf5".format(self.resource_tmp),
+                self.resource_tmp,
+                "{}/training.log".format(self.resource_tmp),
+                False,
+            )
+        self.assertEqual(self.hyperparameters.epochs, len(val_loss))
+        self.assertFalse(network._Network__model._jit_compile)
+        self.assertGreater(int(network._Network__model._steps_per_execution.numpy()), 1)
+
     def test_early_stop_with_patience(self):
         self.hyperparameters.epochs = 3
         self.hyperparameters.es_patience = 0
@@ -307,6 +387,33 @@ class NetworkTests(unittest.TestCase):
             self.assertTrue(len(val_loss) == self.hyperparameters.epochs)
             self.assertTrue(len(val_acc) == self.hyperparameters.epochs)
 
+    def test_shuffle_and_normalise(self):
+        train_data = np.random.rand(10, 20, 2)
+        labels = np.arange(10)
+        normalised, shuffled_labels = Undertest.shuffle_and_normalise(train_data, labels)
+        expected = np.rot90(train_data[shuffled_labels], k=1, axes=(1, 2))
+        expected = expected - np.mean(expected, axis=0)
+        self.assertEqual((10, 2, 20), normalised.shape)
+        self.assertEqual(np.float32, normalised.dtype)
+        self.assertEqual(list(range(10)), sorted(shuffled_labels))
+        np.testing.assert_allclose(expected, normalised, rtol=1e-4, atol=1e-5)
+
+    def test_shuffle_and_normalise_without_rotation(self):
+        train_data = np.random.rand(10, 2, 20)
+        labels = np.arange(10)
+        normalised, shuffled_labels = Undertest.shuffle_and_normalise(train_data, labels, rotate=False)
+        expected = train_data[shuffled_labels] - np.mean(train_data, axis=0)
+        self.assertEqual((10, 2, 20), normalised.shape)
+        np.testing.assert_allclose(expected, normalised, rtol=1e-4, atol=1e-5)
+
+    def test_get_input_shape_from_dump(self):
+        with h5py.File(self.training_dump, "r") as hf:
+            self.assertEqual((2, 20), Undertest.get_input_shape_from_dump(hf["train_data"]))
+        with h5py.File(os.path.join(self.resource_tmp, "training_dump.hdf5"), "w") as hf:
+            hf.create_dataset("train_data", data=np.random.rand(10, 2, 20))
+            hf["train_data"].attrs[Undertest.DUMP_LAYOUT_ATTRIBUTE] = Undertest.INPUT_LAYOUT
+            self.assertEqual((2, 20), Undertest.get_input_shape_from_dump(hf["train_data"]))
+
     @patch("tensorflow.keras.models.Model.fit", side_effect=KeyboardInterrupt)
     def test_throw_exception_on_fit_and_get_history(self, mock_fit):
         try:
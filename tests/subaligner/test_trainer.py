@@ -1,8 +1,13 @@
 import unittest
+import importlib.util
 import os
 import shutil
+import h5py
+import numpy as np
+import tensorflow as tf
 from subaligner.embedder import FeatureEmbedder
 from subaligner.hyperparameters import Hyperparameters
+from subaligner.network import Network
 from subaligner.trainer import Trainer as Undertest
 from subaligner.exception import TerminalException
 from mock import patch
@@ -85,6 +90,18 @@ class TrainerTests(unittest.TestCase):
         )  # one model file, one weights file and one combined file and one training dump
         hyperparams_files = [file for file in output_files if file.endswith(".json")]
         self.assertEqual(1, len(hyperparams_files))
+        with h5py.File(os.path.join(self.resource_tmp, "training_dump.hdf5"), "r") as hf:
+            train_data = hf["train_data"]
+            labels = hf["labels"]
+            self.assertEqual(np.float32, train_data.dtype)
+            self.assertEqual(0, train_data.chunks[0] % self.hyperparameters.batch_size)
+            self.assertEqual("lzf", train_data.compression)
+            self.assertTrue(train_data.shuffle)
+            self.assertEqual(Network.INPUT_LAYOUT, train_data.attrs[Network.DUMP_LAYOUT_ATTRIBUTE])
+            self.assertEqual(np.int8, labels.dtype)
+            self.assertEqual(train_data.chunks[0], labels.chunks[0])
+            self.assertEqual("lzf", labels.compression)
+            self.assertEqual(len(train_data), len(labels))
 
     def test_train_with_mixed_subtitle_formats(self):
         Undertest(FeatureEmbedder(n_mfcc=20, step_sample=0.05)).train(
@@ -166,6 +183,43 @@ class TrainerTests(unittest.TestCase):
         hyperparams_files = [file for file in output_files if file.endswith(".json")]
         self.assertEqual(1, len(hyperparams_files))
 
+    @unittest.skipIf(importlib.util.find_spec("zarr") is None, "zarr is not installed")
+    @patch.dict(os.environ, {"SUBALIGNER_DUMP_FORMAT": "zarr"})
+    def test_train_and_resume_with_zarr_dump(self):
+        underTest = Undertest(FeatureEmbedder(n_mfcc=20, step_sample=0.05))
+        underTest.train(
+            [self.video_file_path, self.audio_file_path],
+            [self.srt_file_path, self.srt_file_path],
+            model_dir=self.resource_tmp,
+            weights_dir=self.resource_tmp,
+            config_dir=self.resource_tmp,
+            logs_dir=self.resource_tmp,
+            training_dump_dir=self.resource_tmp,
+            hyperparameters=self.hyperparameters,
+        )
+        self.assertTrue(os.path.isdir(os.path.join(self.resource_tmp, "training_dump.zarr")))
+        self.assertFalse(os.path.exists(os.path.join(self.resource_tmp, "training_dump.hdf5")))
+
+        hyperparams_file = "{}/hyperparameters.json".format(self.resource_tmp)
+        hyperparameters = Hyperparameters.from_file(hyperparams_file)
+        hyperparameters.epochs = 2
+        hyperparameters.to_file(hyperparams_file)
+
+        underTest.train(
+            None,
+            None,
+            model_dir=self.resource_tmp,
+            weights_dir=self.resource_tmp,
+            config_dir=self.resource_tmp,
+            logs_dir=self.resource_tmp,
+            training_dump_dir=self.resource_tmp,
+            hyperparameters=hyperparameters,
+            resume=True,
+        )
+        output_files = os.listdir(self.resource_tmp)
+        outputs = [file for file in output_files if file.endswith(".hdf5")]
+        self.assertEqual(3, len(outputs))  # one model file, one weights file and one combined file
+
     def test_pre_train(self):
         val_loss, val_acc = Undertest(FeatureEmbedder(n_mfcc=20, step_sample=0.05)).pre_train(
             [self.video_file_path, self.video_file_path],
@@ -192,6 +246,76 @@ class TrainerTests(unittest.TestCase):
         self.assertEqual(self.hyperparameters.epochs, len(val_loss))
         self.assertEqual(self.hyperparameters.epochs, len(val_acc))
 
+    @patch("psutil.virtual_memory")
+    def test_pre_train_with_training_dump_held_in_memory(self, mock_virtual_memory):
+        mock_virtual_memory.return_value.available = 2 ** 40
+        with patch("h5py.File", wraps=h5py.File) as mock_file:
+            val_loss, _ = Undertest(FeatureEmbedder(n_mfcc=20, step_sample=0.05)).pre_train(
+                None,
+                None,
+                training_dump_dir=self.training_dump_dir,
+                hyperparameters=self.hyperparameters,
+            )
+        self.assertEqual(self.hyperparameters.epochs, len(val_loss))
+        self.assertEqual([{"driver": "core", "backing_store": False}], self.__get_dump_opening_kwargs(mock_file))
+
+    @patch("psutil.virtual_memory")
+    def test_pre_train_with_training_dump_larger_than_memory(self, mock_virtual_memory):
+        mock_virtual_memory.return_value.available = 0
+        with patch("h5py.File", wraps=h5py.File) as mock_file:
+            val_loss, _ = Undertest(FeatureEmbedder(n_mfcc=20, step_sample=0.05)).pre_train(
+                None,
+                None,
+                training_dump_dir=self.training_dump_dir,
+                hyperparameters=self.hyperparameters,
+            )
+        self.assertEqual(self.hyperparameters.epochs, len(val_loss))
+        self.assertEqual([{"rdcc_nbytes": Undertest._Trainer__DUMP_CHUNK_CACHE_BYTES}], self.__get_dump_opening_kwargs(mock_file))
+
+    def test_resume_with_training_dump_larger_than_memory(self):
+        underTest = Undertest(FeatureEmbedder(n_mfcc=20, step_sample=0.05))
+        underTest.train(
+            [self.audio_file_path],
+            [self.srt_file_path],
+            model_dir=self.resource_tmp,
+            weights_dir=self.resource_tmp,
+            config_dir=self.resource_tmp,
+            logs_dir=self.resource_tmp,
+            training_dump_dir=self.resource_tmp,
+            hyperparameters=self.hyperparameters,
+            training_log="{}/training.log".format(self.resource_tmp),
+        )
+        hyperparameters = Hyperparameters.from_file("{}/hyperparameters.json".format(self.resource_tmp))
+        hyperparameters.epochs = 2
+
+        with patch("psutil.virtual_memory") as mock_virtual_memory, patch("h5py.File", wraps=h5py.File) as mock_file:
+            mock_virtual_memory.return_value.available = 0
+            underTest.train(
+                None,
+                None,
+                model_dir=self.resource_tmp,
+                weights_dir=self.resource_tmp,
+                config_dir=self.resource_tmp,
+                logs_dir=self.resource_tmp,
+                training_dump_dir=self.resource_tmp,
+                hyperparameters=hyperparameters,
+                training_log="{}/training.log".format(self.resource_tmp),
+                resume=True,
+            )
+        self.assertEqual([{"rdcc_nbytes": Undertest._Trainer__DUMP_CHUNK_CACHE_BYTES}], self.__get_dump_opening_kwargs(mock_file))
+        self.assertEqual(2, Undertest.get_done_epochs("{}/training.log".format(self.resource_tmp)))
+
+    @patch.dict(os.environ, {"SUBALIGNER_FP16": "1"})
+    def test_restore_precision_policy_after_pre_train(self):
+        val_loss, val_acc = Undertest(FeatureEmbedder(n_mfcc=20, step_sample=0.05)).pre_train(
+            None,
+            None,
+            training_dump_dir=self.training_dump_dir,
+            hyperparameters=self.hyperparameters,
+        )
+        self.assertEqual(self.hyperparameters.epochs, len(val_loss))
+        self.assertEqual("float32", tf.keras.mixed_precision.global_policy().name)
+
     def test_no_exception_caused_by_bad_media(self):
         not_a_video = self.srt_file_path
         Undertest(FeatureEmbedder(n_mfcc=20, step_sample=0.05)).train(
@@ -234,12 +358,131 @@ class TrainerTests(unittest.TestCase):
         self.assertEqual(1, len(hyperparams_files))
         Undertest.EMBEDDING_TIMEOUT = timeout
 
+    def test_extract_with_feature_cache(self):
+        feature_embedder = FeatureEmbedder(n_mfcc=20, step_sample=0.05)
+        _, x, y = Undertest._extract_in_multiprocesses(
+            feature_embedder, self.resource_tmp, 0, self.audio_file_path, self.srt_file_path, None, None
+        )
+        cache_files = [file for file in os.listdir(self.resource_tmp) if file.endswith(".h5")]
+        self.assertEqual(1, len(cache_files))
+
+        index, cached_x, cached_y = Undertest._extract_in_multiprocesses(
+            feature_embedder, self.resource_tmp, 1, self.audio_file_path, self.srt_file_path, None, None
+        )
+        self.assertEqual(1, index)
+        np.testing.assert_array_equal(x, cached_x)
+        np.testing.assert_array_equal(y, cached_y)
+        self.assertEqual(x.dtype, cached_x.dtype)
+        self.assertEqual(y.dtype, cached_y.dtype)
+
+    def test_extract_with_unreadable_feature_cache(self):
+        feature_embedder = FeatureEmbedder(n_mfcc=20, step_sample=0.05)
+        _, x, y = Undertest._extract_in_multiprocesses(
+            feature_embedder, self.resource_tmp, 0, self.audio_file_path, self.srt_file_path, None, None
+        )
+        cache_file = [file for file in os.listdir(self.resource_tmp) if file.endswith(".h5")][0]
+        with open(os.path.join(self.resource_tmp, cache_file), "wb") as file:
+            file.write(b"corrupted")
+
+        _, extracted_x, extracted_y = Undertest._extract_in_multiprocesses(
+            feature_embedder, self.resource_tmp, 0, self.audio_file_path, self.srt_file_path, None, None
+        )
+        np.testing.assert_array_equal(x, extracted_x)
+        np.testing.assert_array_equal(y, extracted_y)
+        with h5py.File(os.path.join(self.resource_tmp, cache_file), "r") as hf:
+            np.testing.assert_array_equal(x, hf["train_data"][()])
+
+    def test_cache_full_precision_features(self):
+        feature_embedder = FeatureEmbedder(n_mfcc=20, step_sample=0.05)
+        with patch.dict(os.environ, {"SUBALIGNER_FP16": "1", "SUBALIGNER_FEATURE_DTYPE": "float16"}):
+            _, half_x, _ = Undertest._extract_in_multiprocesses(
+                feature_embedder, self.resource_tmp, 0, self.audio_file_path, self.srt_file_path, None, None
+            )
+        _, x, _ = Undertest._extract_in_multiprocesses(
+            feature_embedder, self.resource_tmp, 0, self.audio_file_path, self.srt_file_path, None, None
+        )
+        self.assertEqual(np.float16, half_x.dtype)
+        self.assertEqual(np.float32, x.dtype)
+        cache_file = [file for file in os.listdir(self.resource_tmp) if file.endswith(".h5")][0]
+        with h5py.File(os.path.join(self.resource_tmp, cache_file), "r") as hf:
+            np.testing.assert_array_equal(x, hf["train_data"][()])
+
+    @patch.dict(os.environ, {"SUBALIGNER_FP16": "1", "SUBALIGNER_FEATURE_DTYPE": "float16"})
+    def test_pre_train_on_float32_features_read_from_half_precision_dump(self):
+        with patch("subaligner.network.Network.shuffle_and_normalise", wraps=Network.shuffle_and_normalise) as mock_shuffle_and_normalise:
+            val_loss, _ = Undertest(FeatureEmbedder(n_mfcc=20, step_sample=0.05)).pre_train(
+                [self.audio_file_path],
+                [self.srt_file_path],
+                training_dump_dir=self.resource_tmp,
+                hyperparameters=self.hyperparameters,
+            )
+        self.assertEqual(self.hyperparameters.epochs, len(val_loss))
+        self.assertEqual(np.float32, mock_shuffle_and_normalise.call_args[0][0].dtype)
+        with h5py.File(os.path.join(self.resource_tmp, "training_dump.hdf5"), "r") as hf:
+            self.assertEqual(np.float16, hf["train_data"].dtype)
+
+    @patch.dict(os.environ, {"OMP_NUM_THREADS": "4"})
+    def test_restore_worker_thread_env_vars_after_extraction(self):
+        os.environ.pop("MKL_NUM_THREADS", None)
+        os.environ.pop("OPENBLAS_NUM_THREADS", None)
+        Undertest(FeatureEmbedder(n_mfcc=20, step_sample=0.05)).pre_train(
+            [self.audio_file_path],
+            [self.srt_file_path],
+            training_dump_dir=self.resource_tmp,
+            hyperparameters=self.hyperparameters,
+        )
+        self.assertEqual("4", os.environ["OMP_NUM_THREADS"])
+        self.assertNotIn("MKL_NUM_THREADS", os.environ)
+        self.assertNotIn("OPENBLAS_NUM_THREADS", os.environ)
+
+    def test_extract_without_pinning_main_process_threads(self):
+        with patch("tensorflow.config.threading.set_intra_op_parallelism_threads") as mock_set_intra_op, \
+                patch("tensorflow.config.threading.set_inter_op_parallelism_threads") as mock_set_inter_op:
+            Undertest._extract_in_multiprocesses(
+                FeatureEmbedder(n_mfcc=20, step_sample=0.05), None, 0, self.audio_file_path, self.srt_file_path, None, None
+            )
+        self.assertFalse(mock_set_intra_op.called)
+        self.assertFalse(mock_set_inter_op.called)
+
+    def test_extract_without_feature_cache(self):
+        _, x, y = Undertest._extract_in_multiprocesses(
+            FeatureEmbedder(n_mfcc=20, step_sample=0.05), None, 0, self.audio_file_path, self.srt_file_path, None, None
+        )
+        self.assertEqual(len(x), len(y))
+        self.assertEqual([], os.listdir(self.resource_tmp))
+
+    @patch("subaligner.embedder.FeatureEmbedder.extract_data_and_label_from_audio",
+           return_value=(np.zeros((2, 20, 3)), np.array([0.0, 300.0])))
+    def test_skip_media_with_labels_out_of_int8_range(self, mock_extract_data_and_label_from_audio):
+        index, x, y = Undertest._extract_in_multiprocesses(
+            FeatureEmbedder(n_mfcc=20, step_sample=0.05), None, 0, self.audio_file_path, self.srt_file_path, None, None
+        )
+        self.assertTrue(mock_extract_data_and_label_from_audio.called)
+        self.assertEqual(0, index)
+        self.assertIsNone(x)
+        self.assertIsNone(y)
+
+    @patch.dict(os.environ, {"SUBALIGNER_FEATURE_CACHE": "0"})
+    def test_pre_train_with_feature_cache_disabled(self):
+        Undertest(FeatureEmbedder(n_mfcc=20, step_sample=0.05)).pre_train(
+            [self.audio_file_path],
+            [self.srt_file_path],
+            training_dump_dir=self.resource_tmp,
+            hyperparameters=self.hyperparameters,
+        )
+        self.assertFalse(os.path.exists(os.path.join(self.resource_tmp, "feature_cache")))
+
+    def test_throw_exception_on_modifying_attributes(self):
+        trainer = Undertest(FeatureEmbedder(n_mfcc=20, step_sample=0.05))
+        self.assertRaises(NotImplementedError, setattr, trainer, "feature_embedder", None)
+        self.assertRaises(NotImplementedError, delattr, trainer, "_Trainer__feature_embedder")
+
     def test_get_done_epochs(self):
         assert Undertest.get_done_epochs(self.training_log_path) == 1
         assert Undertest.get_done_epochs("not_exist_training.log") == 0
 
-    @patch("concurrent.futures.wait", side_effect=KeyboardInterrupt)
-    def test_throw_exception_on_training_interrupted(self, mock_wait):
+    @patch("concurrent.futures.as_completed", side_effect=KeyboardInterrupt)
+    def test_throw_exception_on_training_interrupted(self, mock_as_completed):
         try:
             Undertest(FeatureEmbedder(n_mfcc=20, step_sample=0.05)).train(
                 [self.video_file_path, self.video_file_path],
@@ -252,12 +495,19 @@ class TrainerTests(unittest.TestCase):
                 hyperparameters=self.hyperparameters,
             )
         except Exception as e:
-            self.assertTrue(mock_wait.called)
+            self.assertTrue(mock_as_completed.called)
             self.assertTrue(isinstance(e, TerminalException))
             self.assertTrue("interrupted" in str(e))
+            self.assertFalse([file for file in os.listdir(self.resource_tmp) if file.startswith("training_dump")])
         else:
             self.fail("Should have thrown exception")
 
+    @staticmethod
+    def __get_dump_opening_kwargs(mock_file):
+        return [
+            kwargs for args, kwargs in mock_file.call_args_list if args and str(args[0]).endswith("training_dump.hdf5") and args[1:] == ("r",)
+        ]
+
 
 if __name__ == "__main__":
     unittest.main()